@@ -23,7 +23,6 @@ from config_utils import (
     save_config,
     ensure_directories,
 )
-import cv2
 from camera_pi import PiCameraStream
 from telegram_utils import send_to_telegram
 
@@ -754,19 +753,18 @@ def generate_video_stream():
             raise Exception("Impossible de démarrer la Pi Camera")
 
         while True:
-            frame = pi_camera.get_frame()
-            if frame is not None:
-                _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                data = jpeg.tobytes()
+            data = pi_camera.get_jpeg()
+            if data is not None:
                 # Stocker la frame pour capture instantanée
                 with frame_lock:
                     last_frame = data
 
                 # Envoyer la frame au navigateur
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n'
-                       b'Content-Length: ' + str(len(data)).encode() + b'\r\n\r\n' +
-                       data + b'\r\n')
+                # join() accepte directement le tampon JPEG, sans copie intermédiaire
+                yield b''.join((b'--frame\r\n'
+                                b'Content-Type: image/jpeg\r\n'
+                                b'Content-Length: ' + str(len(data)).encode() + b'\r\n\r\n',
+                                data, b'\r\n'))
             else:
                 time.sleep(0.03)
 
@@ -1,12 +1,25 @@
 import logging
 import subprocess
 import shutil
-from typing import Tuple
+import threading
+from typing import Optional, Tuple, Union
 
 import cv2
 
+from camera_utils import (
+    AdaptiveJpegEncoder,
+    JpegSink,
+    LatestFrameReader,
+    find_capture_devices,
+    maybe_set,
+    preview_size,
+)
+
 logger = logging.getLogger(__name__)
 
+# JPEG encodé : bytes (codeur matériel, libjpeg-turbo) ou memoryview (OpenCV)
+JpegBuffer = Union[bytes, memoryview]
+
 
 class PiCameraStream:
     """Gestion de la caméra Raspberry Pi via Picamera2 avec repli OpenCV."""
@@ -16,6 +29,14 @@ class PiCameraStream:
         self.picam2 = None
         self.cap = None
         self.still_config = None
+        self.encoder = None  # codeur JPEG matériel Picamera2
+        self._jpeg = None
+        self._jpeg_id = 0
+        self._jpeg_seen = 0
+        self._jpeg_cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._libcamera_still = shutil.which("libcamera-still")
+        self._cap_lock = threading.Lock()  # flux OpenCV partagé avec capture_photo()
 
     def open(
         self,
@@ -26,6 +47,8 @@ class PiCameraStream:
         vflip: bool = False,
     ) -> bool:
         """Ouvre la caméra avec les paramètres donnés."""
+        self._stop_event.clear()
+        self._jpeg_encoder = AdaptiveJpegEncoder(framerate)
         try:
             from picamera2 import Picamera2
             from libcamera import Transform, controls
@@ -33,10 +56,16 @@ class PiCameraStream:
             self.backend = "picamera2"
             self.picam2 = Picamera2()
             transform = Transform(rotation=rotate, hflip=hflip, vflip=vflip)
+            # Aperçu encodé depuis le flux 'lores' réduit par l'ISP
             config = self.picam2.create_preview_configuration(
                 main={"size": resolution, "format": "BGR888"},
+                lores={"size": preview_size(resolution), "format": "YUV420"},
+                encode="lores",
                 transform=transform,
+                buffer_count=4,
+                queue=True,
             )
+            self.picam2.align_configuration(config)
             self.picam2.configure(config)
             try:
                 self.picam2.set_controls({"FrameRate": framerate})
@@ -47,7 +76,14 @@ class PiCameraStream:
             except Exception:
                 pass
             self.picam2.start()
-            self.still_config = self.picam2.create_still_configuration(transform=transform)
+            # Méthodes liées au backend : pas de test de backend à chaque frame
+            self.get_frame = self._get_frame_picamera2
+            self.capture_photo = self._capture_photo_picamera2
+            # Un seul buffer pleine résolution suffit pour la photo
+            self.still_config = self.picam2.create_still_configuration(
+                transform=transform, buffer_count=1
+            )
+            self._start_encoder()
             return True
         except Exception as e:
             logger.warning(
@@ -57,75 +93,182 @@ class PiCameraStream:
 
         # Fallback OpenCV
         self.backend = "opencv"
+        self._resolution = resolution
+        self._framerate = framerate
+        # Sans nœud identifié (droits, ioctl refusé), tenter l'index 0
+        for self._device in find_capture_devices() or [0]:
+            if self._open_capture() and self.cap.grab():
+                break
+            logger.info("Caméra %s inutilisable via OpenCV", self._device)
+            self.cap.release()
+        else:
+            logger.error("Impossible d'ouvrir la caméra via OpenCV")
+            self.cap = None
+            self._unbind_backend()
+            return False
+        self.get_frame = self._get_frame_opencv
+        self.get_jpeg = self._get_jpeg_opencv
+        self.capture_photo = self._capture_photo_opencv
+        return True
+
+    def _open_capture(self) -> bool:
+        """Ouvre (ou rouvre) le flux OpenCV sur le périphérique sélectionné."""
         # Le backend V4L2 est recommandé pour les caméras Pi via OpenCV
-        self.cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+        self.cap = cv2.VideoCapture(self._device, cv2.CAP_V4L2)
         if not self.cap.isOpened():
-            logger.error("Impossible d'ouvrir la caméra via OpenCV")
             return False
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
-        self.cap.set(cv2.CAP_PROP_FPS, framerate)
+        try:
+            # Un seul buffer V4L2 : read() renvoie la frame la plus récente
+            maybe_set(self.cap, cv2.CAP_PROP_BUFFERSIZE, 1)
+        except Exception:
+            pass
+        maybe_set(self.cap, cv2.CAP_PROP_FRAME_WIDTH, self._resolution[0])
+        maybe_set(self.cap, cv2.CAP_PROP_FRAME_HEIGHT, self._resolution[1])
+        maybe_set(self.cap, cv2.CAP_PROP_FPS, self._framerate)
+        self._reader = LatestFrameReader(self.cap, 1.0 / self._framerate)
         return True
 
+    def _start_encoder(self) -> None:
+        """Démarre le codeur JPEG matériel s'il est disponible."""
+        try:
+            from picamera2.encoders import MJPEGEncoder, Quality
+            from picamera2.outputs import FileOutput
+
+            self.encoder = MJPEGEncoder()
+            self.picam2.start_encoder(
+                self.encoder, FileOutput(JpegSink(self._on_jpeg)), quality=Quality.HIGH
+            )
+            self.get_jpeg = self._get_jpeg_encoder
+        except Exception as e:
+            logger.warning("Codeur JPEG matériel indisponible (%s), encodage logiciel", e)
+            self.encoder = None
+            self.get_jpeg = self._get_jpeg_lores
+
+    def _on_jpeg(self, jpeg: bytes) -> None:
+        with self._jpeg_cond:
+            self._jpeg = jpeg
+            self._jpeg_id += 1
+            self._jpeg_cond.notify_all()
+
+    def _unbind_backend(self) -> None:
+        """Retire les méthodes liées au backend (caméra non initialisée)."""
+        for name in ("get_frame", "get_jpeg", "capture_photo"):
+            self.__dict__.pop(name, None)
+
+    def get_jpeg(self, timeout: float = 1.0) -> Optional[JpegBuffer]:
+        """Retourne la prochaine frame JPEG (objet bytes-like) ou None."""
+        return None
+
+    def _get_jpeg_opencv(self, timeout: float = 1.0) -> Optional[JpegBuffer]:
+        frame = self._get_frame_opencv()
+        if frame is None:
+            return None
+        return self._jpeg_encoder.encode(frame)
+
+    def _get_jpeg_encoder(self, timeout: float = 1.0) -> Optional[JpegBuffer]:
+        with self._jpeg_cond:
+            if not self._jpeg_cond.wait_for(
+                lambda: self._jpeg_id != self._jpeg_seen or self._stop_event.is_set(),
+                timeout,
+            ) or self._stop_event.is_set():
+                return None
+            self._jpeg_seen = self._jpeg_id
+            return self._jpeg
+
+    def _get_jpeg_lores(self, timeout: float = 1.0) -> Optional[JpegBuffer]:
+        try:
+            yuv = self.picam2.capture_array("lores")
+        except Exception as e:
+            logger.error("Erreur capture Picamera2: %s", e)
+            return None
+        frame = cv2.cvtColor(yuv, cv2.COLOR_YUV420p2BGR)
+        return self._jpeg_encoder.encode(frame)
+
     def get_frame(self):
         """Retourne une frame BGR ou None en cas d'erreur."""
-        if self.backend == "picamera2" and self.picam2:
-            try:
-                return self.picam2.capture_array("main")
-            except Exception as e:
-                logger.error("Erreur capture Picamera2: %s", e)
-                return None
-        elif self.backend == "opencv" and self.cap:
-            ret, frame = self.cap.read()
-            if ret:
-                return frame
+        return None
+
+    def _get_frame_picamera2(self):
+        try:
+            return self.picam2.capture_array("main")
+        except Exception as e:
+            logger.error("Erreur capture Picamera2: %s", e)
             return None
+
+    def _get_frame_opencv(self):
+        # Le consommateur peut être plus lent que le capteur : frame la plus récente
+        with self._cap_lock:
+            ret, frame = self._reader.read()
+        if ret:
+            return frame
         return None
 
     def capture_photo(self, path: str) -> None:
         """Capture une photo pleine résolution et l'enregistre."""
-        if self.backend == "picamera2" and self.picam2:
-            try:
-                if self.still_config:
+        raise RuntimeError("Caméra non initialisée")
+
+    def _capture_photo_picamera2(self, path: str) -> None:
+        try:
+            if self.still_config:
+                # Le changement de mode est impossible pendant l'encodage
+                if self.encoder:
+                    self.picam2.stop_encoder()
+                try:
                     self.picam2.switch_mode_and_capture_file(self.still_config, path)
-                else:
-                    self.picam2.capture_file(path)
-            except Exception as e:
-                logger.error("Erreur capture photo Picamera2: %s", e)
-                raise
-        elif self.backend == "opencv" and self.cap:
-            # Si les utilitaires libcamera sont disponibles, utiliser libcamera-still
-            libcamera_still = shutil.which("libcamera-still")
-            if libcamera_still:
+                finally:
+                    if self.encoder:
+                        self._start_encoder()
+            else:
+                self.picam2.capture_file(path)
+        except Exception as e:
+            logger.error("Erreur capture photo Picamera2: %s", e)
+            raise
+
+    def _capture_photo_opencv(self, path: str) -> None:
+        with self._cap_lock:
+            # Si les utilitaires libcamera sont disponibles, utiliser libcamera-still ;
+            # le flux OpenCV est libéré le temps de la photo pour lui laisser le capteur
+            if self._libcamera_still:
+                self.cap.release()
                 try:
                     subprocess.run(
-                        [libcamera_still, "-o", path, "--immediate"],
+                        [self._libcamera_still, "-n", "-o", path, "--immediate"],
                         check=True,
                         stdout=subprocess.PIPE,
                         stderr=subprocess.PIPE,
                     )
                     return
-                except subprocess.CalledProcessError as e:
+                except (OSError, subprocess.CalledProcessError) as e:
                     logger.error(
                         "libcamera-still a échoué (%s), repli sur OpenCV pour la capture", e
                     )
+                finally:
+                    if not self._open_capture():
+                        logger.error("Impossible de rouvrir la caméra via OpenCV")
             ret, frame = self.cap.read()
             if not ret:
                 raise RuntimeError("Impossible de capturer une image")
             cv2.imwrite(path, frame)
-        else:
-            raise RuntimeError("Caméra non initialisée")
 
     def close(self) -> None:
         """Ferme la caméra et libère les ressources."""
+        # Débloque immédiatement les attentes de frame ou de photo en cours
+        self._stop_event.set()
+        with self._jpeg_cond:
+            self._jpeg_cond.notify_all()
         if self.backend == "picamera2" and self.picam2:
             try:
+                if self.encoder:
+                    self.picam2.stop_encoder()
                 self.picam2.stop()
             except Exception:
                 pass
             self.picam2.close()
             self.picam2 = None
+            self.encoder = None
         elif self.backend == "opencv" and self.cap:
-            self.cap.release()
+            with self._cap_lock:
+                self.cap.release()
             self.cap = None
+        self._unbind_backend()
         self.backend = None
@@ -1,26 +1,254 @@
+import collections
 import cv2
+import glob
+import io
+import os
+import re
+import struct
+import sys
 import threading
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+__all__ = [
+    'AdaptiveJpegEncoder',
+    'JpegSink',
+    'LatestFrameReader',
+    'PiCamera',
+    'encode_jpeg',
+    'find_capture_devices',
+    'maybe_set',
+    'preview_size',
+    'queue_size',
+]
+
+VIDIOC_QUERYCAP = 0x80685600
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+# Pilotes mémoire-à-mémoire du Pi (ISP, codecs) : leurs nœuds de sortie annoncent
+# V4L2_CAP_VIDEO_CAPTURE mais ne produisent rien sans tampon d'entrée
+_M2M_DRIVERS = ('bcm2835-isp', 'bcm2835-codec', 'pispbe', 'rpi-hevc-dec')
+
+
+try:
+    # libjpeg-turbo (optionnel) : encodage SIMD NEON sur ARM
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbojpeg = TurboJPEG()
+except Exception:
+    _turbojpeg = None
+
+
+def encode_jpeg(image, quality=85):
+    """Encode une frame BGR en JPEG, via libjpeg-turbo si disponible.
+
+    Retourne un objet bytes-like (``bytes`` ou ``memoryview`` sur le tampon
+    OpenCV) afin d'éviter la copie de ``tobytes()``.
+    """
+    if _turbojpeg is not None:
+        return _turbojpeg.encode(image, quality=quality, pixel_format=TJPF_BGR)
+    _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return memoryview(jpeg).cast('B')
+
+
+class AdaptiveJpegEncoder:
+    """Encodeur JPEG qui baisse la qualité quand l'encodage dépasse le budget.
+
+    Le budget vaut 90 % de la période d'une frame ; la moyenne mobile du temps
+    d'encodage fait descendre la qualité jusqu'à ``min_quality`` en cas de
+    dépassement et la ramène à ``quality`` dès que la marge revient.
+    """
+
+    def __init__(self, framerate, quality=85, min_quality=60):
+        self.base_quality = quality
+        self.min_quality = min_quality
+        self.quality = quality
+        self._budget_ns = 0.9 * 1e9 / framerate
+        self._ema_ns = 0.0
+
+    def encode(self, image):
+        start = time.perf_counter_ns()
+        jpeg = encode_jpeg(image, self.quality)
+        self._ema_ns = 0.9 * self._ema_ns + 0.1 * (time.perf_counter_ns() - start)
+        excess = (self._ema_ns - self._budget_ns) / self._budget_ns
+        self.quality = max(self.min_quality,
+                           min(self.base_quality, self.base_quality - int(excess * 25)))
+        return jpeg
+
+
+def preview_size(resolution, max_width=640):
+    """Taille du flux 'lores' picamera2 utilisé pour l'aperçu MJPEG.
+
+    Conserve le rapport d'aspect de ``resolution`` sans jamais la dépasser ;
+    les dimensions sont paires, comme l'exige le format YUV420.
+    """
+    width, height = resolution
+    if width > max_width:
+        width, height = max_width, height * max_width // width
+    return (width - width % 2, height - height % 2)
+
+
+def _tune_capture_thread():
+    """Épingle le thread courant sur le dernier cœur et le passe en SCHED_FIFO.
+
+    Utilisé par les boucles de capture de PiCamera. Sans au moins deux cœurs
+    disponibles, rien n'est modifié : un thread FIFO affamerait le serveur.
+    SCHED_FIFO exige CAP_SYS_NICE ; sans elle, le thread reste sur
+    l'ordonnanceur par défaut.
+    """
+    try:
+        cpus = os.sched_getaffinity(0)
+    except (AttributeError, OSError) as e:
+        logger.info(f"[PI CAMERA] Affinité CPU non appliquée: {e}")
+        return
+    if len(cpus) < 2:
+        return
+    try:
+        os.sched_setaffinity(0, {max(cpus)})
+    except OSError as e:
+        logger.info(f"[PI CAMERA] Affinité CPU non appliquée: {e}")
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(20))
+    except (AttributeError, OSError) as e:
+        logger.info(f"[PI CAMERA] Priorité temps réel non appliquée: {e}")
+
+
+class LatestFrameReader:
+    """Lit la frame la plus récente d'un VideoCapture en vidant la file du pilote.
+
+    Le nombre de frames potentiellement en file est déduit du temps écoulé
+    depuis la lecture précédente : seules celles-ci sont écartées par grab(),
+    qui ne décode pas, dans la limite de la taille de file, avant un seul
+    retrieve(). Un consommateur plus rapide que le capteur ne jette rien.
+    """
+
+    def __init__(self, cap, frame_period):
+        self.cap = cap
+        self.frame_period = frame_period
+        self.queue_size = queue_size(cap)
+        self._last_read = None
+
+    def read(self):
+        stale = 0
+        if self._last_read is not None:
+            elapsed = time.monotonic() - self._last_read
+            stale = min(self.queue_size - 1, int(elapsed / self.frame_period))
+        for _ in range(stale + 1):
+            if not self.cap.grab():
+                return False, None
+        self._last_read = time.monotonic()
+        return self.cap.retrieve()
+
+
+def maybe_set(cap, prop, value):
+    """Applique une propriété VideoCapture seulement si sa valeur diffère.
+
+    Chaque set() peut renégocier le format avec le pilote V4L2 (50 à 200 ms).
+    """
+    if int(cap.get(prop)) == int(value):
+        return True
+    return cap.set(prop, value)
+
+
+def queue_size(cap, default=4):
+    """Retourne la taille de file effective d'un VideoCapture."""
+    try:
+        return int(cap.get(cv2.CAP_PROP_BUFFERSIZE)) or default
+    except Exception:
+        return default
+
+
+def find_capture_devices():
+    """Retourne les index des périphériques /dev/videoN capables de capture vidéo.
+
+    Sur Linux, les nœuds sont filtrés via l'ioctl VIDIOC_QUERYCAP sans ouvrir
+    de VideoCapture : les nœuds sans V4L2_CAP_VIDEO_CAPTURE (métadonnées, entrées
+    codec) sont ignorés, ainsi que ceux des pilotes ISP/codec listés dans
+    _M2M_DRIVERS.
+    Sur les autres systèmes, retourne simplement [0].
+    """
+    if not sys.platform.startswith('linux'):
+        return [0]
+    import fcntl
+    devices = []
+    for path in glob.glob('/dev/video*'):
+        match = re.fullmatch(r'/dev/video(\d+)', path)
+        if not match:
+            continue
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        except OSError:
+            continue
+        try:
+            caps = bytearray(104)  # struct v4l2_capability
+            fcntl.ioctl(fd, VIDIOC_QUERYCAP, caps)
+        except OSError:
+            continue
+        finally:
+            os.close(fd)
+        driver = bytes(caps[:16]).split(b'\0', 1)[0].decode('ascii', 'replace')
+        if driver.startswith(_M2M_DRIVERS):
+            continue
+        capabilities, device_caps = struct.unpack_from('<II', caps, 84)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        if capabilities & V4L2_CAP_VIDEO_CAPTURE:
+            devices.append(int(match.group(1)))
+    return sorted(devices)
+
+
+class JpegSink(io.BufferedIOBase):
+    """Sortie fichier factice recevant les JPEG du codeur matériel picamera2."""
+
+    def __init__(self, callback):
+        super().__init__()
+        self._callback = callback
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        self._callback(bytes(buf))
+        return len(buf)
+
 
 class PiCamera:
     """Gestion de la caméra Raspberry Pi avec différents backends."""
 
+    # Délai sans appel à get_frame() avant de suspendre l'encodage
+    IDLE_TIMEOUT = 2.0
+
     def __init__(self, resolution=(1280, 720), framerate=30):
         self.resolution = resolution
         self.framerate = framerate
-        self.frame = None
-        self.lock = threading.Lock()
-        self.is_running = False
+        self._jpeg_encoder = AdaptiveJpegEncoder(framerate)
+        # Tampon ping-pong producteur/consommateur des frames JPEG
+        self._slots = [None, None]
+        self._head = 0
+        # File bornée capture -> encodage : la frame la plus ancienne est écartée
+        self._raw_frames = collections.deque(maxlen=1)
+        self._frame_ready = threading.Event()
+        self._last_read = 0.0  # dernier appel à get_frame() (time.monotonic)
         self.thread = None
+        self.encoder_thread = None
+        self._stop_event = threading.Event()
+        self._stop_event.set()  # caméra arrêtée tant que start() n'a pas réussi
         self.backend = None  # 'picamera', 'picamera2' ou 'opencv'
         self.camera = None   # objet caméra selon le backend
+        self.encoder = None  # codeur JPEG matériel (picamera2)
+
+    @property
+    def is_running(self):
+        """Vrai entre un start() réussi et stop()."""
+        return not self._stop_event.is_set()
 
     def start(self):
         """Initialise la caméra Pi en testant plusieurs bibliothèques."""
+        self._stop_event.clear()
+        self._clear_frames()
+        # Considère le démarrage comme une demande : la première frame est publiée
+        self._last_read = time.monotonic()
         # Essayer d'abord la bibliothèque picamera (ancienne)
         try:
             import picamera
@@ -30,10 +258,8 @@ class PiCamera:
             self.camera.resolution = self.resolution
             self.camera.framerate = self.framerate
             self._raw_capture = picamera.array.PiRGBArray(self.camera, size=self.resolution)
-            self.is_running = True
-            self.thread = threading.Thread(target=self._capture_loop_picamera)
-            self.thread.daemon = True
-            self.thread.start()
+            self.capture_photo = self._capture_photo_picamera
+            self._start_threads(self._capture_loop_picamera)
             logger.info("[PI CAMERA] Caméra initialisée via picamera")
             return True
         except Exception as e:
@@ -44,114 +270,238 @@ class PiCamera:
             from picamera2 import Picamera2
             self.backend = 'picamera2'
             self.camera = Picamera2()
-            config = self.camera.create_preview_configuration(main={"size": self.resolution})
+            # 24 bpp sans canal alpha ; "RGB888" correspond à l'ordre BGR d'OpenCV
+            # L'aperçu est encodé depuis le flux 'lores' réduit par l'ISP ;
+            # 'main' reste en pleine résolution pour capture_photo()
+            config = self.camera.create_preview_configuration(
+                main={"size": self.resolution, "format": "RGB888"},
+                lores={"size": preview_size(self.resolution), "format": "YUV420"},
+                encode="lores",
+                buffer_count=4,
+                queue=True,
+            )
+            self.camera.align_configuration(config)
             self.camera.configure(config)
+            self.capture_photo = self._capture_photo_picamera2
+            try:
+                # Encodage JPEG par le codeur matériel : aucune boucle de capture
+                from picamera2.encoders import MJPEGEncoder, Quality
+                from picamera2.outputs import FileOutput
+                self.encoder = MJPEGEncoder()
+                self.camera.start_recording(self.encoder, FileOutput(JpegSink(self._on_jpeg)),
+                                            quality=Quality.HIGH)
+                logger.info("[PI CAMERA] Caméra initialisée via picamera2 (JPEG matériel)")
+                return True
+            except Exception as e_encoder:
+                logger.info(f"[PI CAMERA] Codeur JPEG matériel indisponible: {e_encoder}")
+                self.encoder = None
             self.camera.start()
-            self.is_running = True
-            self.thread = threading.Thread(target=self._capture_loop_picamera2)
-            self.thread.daemon = True
-            self.thread.start()
+            self._start_threads(self._capture_loop_picamera2)
             logger.info("[PI CAMERA] Caméra initialisée via picamera2")
             return True
         except Exception as e:
             logger.info(f"[PI CAMERA] picamera2 indisponible: {e}")
 
-        # Enfin, essayer OpenCV avec différents backends
+        # Enfin, essayer OpenCV
         try:
             self.backend = 'opencv'
-            backends = [cv2.CAP_V4L2, cv2.CAP_ANY]
-            for backend in backends:
-                backend_name = 'V4L2' if backend == cv2.CAP_V4L2 else 'AUTO'
-                logger.info(f"[PI CAMERA] Tentative d'ouverture via OpenCV backend {backend_name}...")
-                try:
-                    self.camera = cv2.VideoCapture(0, backend)
-                    if not self.camera.isOpened():
-                        logger.info(f"[PI CAMERA] Backend {backend_name} : échec d'ouverture")
-                        if self.camera:
-                            self.camera.release()
-                        continue
-                    self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
-                    self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
-                    self.camera.set(cv2.CAP_PROP_FPS, self.framerate)
-                    self.is_running = True
-                    self.thread = threading.Thread(target=self._capture_loop_opencv)
-                    self.thread.daemon = True
-                    self.thread.start()
-                    logger.info(f"[PI CAMERA] Caméra initialisée via OpenCV backend {backend_name}")
-                    return True
-                except Exception as e_backend:
-                    logger.info(f"[PI CAMERA] Erreur backend {backend_name}: {e_backend}")
-                    if self.camera:
-                        self.camera.release()
-                    self.camera = None
-                    continue
-            raise RuntimeError("Impossible d'ouvrir la caméra Pi avec OpenCV")
+            return self._initialize_opencv()
         except Exception as e:
             logger.info(f"[PI CAMERA] Erreur initialisation OpenCV: {e}")
             self.camera = None
+            self._unbind_backend()
+            self._stop_event.set()
             return False
 
+    def _initialize_opencv(self):
+        """Ouvre le premier périphérique de capture disponible via OpenCV."""
+        # Seul V4L2 s'applique sous Linux
+        if sys.platform.startswith('linux'):
+            backend, backend_name = cv2.CAP_V4L2, 'V4L2'
+        else:
+            backend, backend_name = cv2.CAP_ANY, 'AUTO'
+        # Sans nœud identifié (droits, ioctl refusé), tenter l'index 0 comme avant
+        for index in find_capture_devices() or [0]:
+            logger.info(f"[PI CAMERA] Tentative d'ouverture de la caméra {index} via OpenCV backend {backend_name}...")
+            try:
+                self.camera = cv2.VideoCapture(index, backend)
+                if not self.camera.isOpened():
+                    logger.info(f"[PI CAMERA] Caméra {index} : échec d'ouverture")
+                    if self.camera:
+                        self.camera.release()
+                    continue
+                try:
+                    # Un seul buffer V4L2 : read() renvoie la frame la plus récente
+                    maybe_set(self.camera, cv2.CAP_PROP_BUFFERSIZE, 1)
+                except Exception:
+                    pass
+                maybe_set(self.camera, cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+                maybe_set(self.camera, cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+                maybe_set(self.camera, cv2.CAP_PROP_FPS, self.framerate)
+                # Une seule lecture pour vérifier que le périphérique produit des frames ;
+                # la résolution négociée est lue via get(), sans frame supplémentaire
+                if not self.camera.grab():
+                    logger.info(f"[PI CAMERA] Caméra {index} : aucune frame reçue")
+                    self.camera.release()
+                    continue
+                width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
+                height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                self.capture_photo = self._capture_photo_opencv
+                self._start_threads(self._capture_loop_opencv)
+                logger.info(f"[PI CAMERA] Caméra {index} initialisée via OpenCV backend {backend_name} ({width}x{height})")
+                return True
+            except Exception as e_backend:
+                logger.info(f"[PI CAMERA] Erreur caméra {index}: {e_backend}")
+                if self.camera:
+                    self.camera.release()
+                self.camera = None
+                continue
+        raise RuntimeError("Impossible d'ouvrir la caméra Pi avec OpenCV")
+
+    def _unbind_backend(self):
+        """Retire les méthodes liées au backend (caméra non initialisée)."""
+        self.__dict__.pop('capture_photo', None)
+
+    def _start_threads(self, capture_loop):
+        """Démarre le thread de capture et le thread d'encodage JPEG."""
+        self.thread = threading.Thread(target=capture_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        self.encoder_thread = threading.Thread(target=self._encode_loop)
+        self.encoder_thread.daemon = True
+        self.encoder_thread.start()
+
+    def _clear_frames(self):
+        # Aucune frame périmée ne doit être servie comme si elle était actuelle
+        self._slots = [None, None]
+        self._raw_frames.clear()
+
+    def _has_demand(self):
+        """Vrai si get_frame() a été appelé récemment ; sinon vide les frames publiées."""
+        if time.monotonic() - self._last_read < self.IDLE_TIMEOUT:
+            return True
+        if self._slots != [None, None]:
+            self._clear_frames()
+        return False
+
+    def _store_frame(self, image):
+        # Sans demande, inutile de transmettre la frame à l'encodeur
+        if not self._has_demand():
+            return
+        self._raw_frames.append(image)
+        self._frame_ready.set()
+
+    def _store_jpeg(self, jpeg):
+        # Écriture dans le slot inactif puis bascule : le lecteur ne bloque jamais
+        # l'écrivain (les affectations d'attributs sont atomiques sous le GIL)
+        slot = self._head ^ 1
+        self._slots[slot] = jpeg
+        self._head = slot
+
+    def _encode_loop(self):
+        while not self._stop_event.is_set():
+            if not self._frame_ready.wait(1.0):
+                continue
+            self._frame_ready.clear()
+            try:
+                image = self._raw_frames.popleft()
+            except IndexError:
+                continue
+            try:
+                self._store_jpeg(self._jpeg_encoder.encode(image))
+            except Exception as e:
+                logger.info(f"[PI CAMERA] Erreur encodage JPEG: {e}")
+
+    def _on_jpeg(self, jpeg):
+        if self._has_demand():
+            self._store_jpeg(jpeg)
+
     def _capture_loop_picamera(self):
-        import numpy as np  # utilisé pour conversion
+        _tune_capture_thread()
         for frame in self.camera.capture_continuous(self._raw_capture, format='bgr', use_video_port=True):
-            image = frame.array
-            _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            with self.lock:
-                self.frame = jpeg.tobytes()
+            self._store_frame(frame.array)
             self._raw_capture.truncate(0)
-            if not self.is_running:
+            if self._stop_event.is_set():
                 break
 
     def _capture_loop_picamera2(self):
-        while self.is_running:
+        from picamera2 import MappedArray
+        _tune_capture_thread()
+        # capture_request() bloque jusqu'à la prochaine frame : pas de sleep
+        while not self._stop_event.is_set():
             try:
-                image = self.camera.capture_array()
-                _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                with self.lock:
-                    self.frame = jpeg.tobytes()
+                request = self.camera.capture_request()
+                image = None
+                try:
+                    if self._has_demand():
+                        # Conversion depuis une vue sur le buffer DMA du flux réduit, sans memcpy pleine résolution
+                        with MappedArray(request, 'lores') as mapped:
+                            image = cv2.cvtColor(mapped.array, cv2.COLOR_YUV420p2BGR)
+                finally:
+                    # cvtColor a copié la frame : le buffer retourne à la file avant l'encodage
+                    request.release()
+                if image is not None:
+                    self._store_frame(image)
             except Exception as e:
                 logger.info(f"[PI CAMERA] Erreur capture picamera2: {e}")
-            time.sleep(0.03)
+                if self._stop_event.wait(1.0):
+                    break
 
     def _capture_loop_opencv(self):
-        while self.is_running:
-            ret, image = self.camera.read()
+        _tune_capture_thread()
+        # grab() bloque jusqu'à la fin du transfert V4L2 : pas de sleep
+        reader = LatestFrameReader(self.camera, 1.0 / self.framerate)
+        while not self._stop_event.is_set():
+            ret, image = reader.read()
             if ret:
-                _, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                with self.lock:
-                    self.frame = jpeg.tobytes()
+                self._store_frame(image)
             else:
                 logger.info("[PI CAMERA] Erreur de lecture de frame")
-            time.sleep(0.03)
+                if self._stop_event.wait(1.0):
+                    break
 
     def get_frame(self):
-        with self.lock:
-            return self.frame
+        """Retourne la dernière frame encodée en JPEG, ou None si aucune n'est récente."""
+        now = time.monotonic()
+        if now - self._last_read >= self.IDLE_TIMEOUT:
+            # Encodage suspendu : la frame publiée date d'avant la pause
+            self._clear_frames()
+        self._last_read = now
+        return self._slots[self._head]
 
     def capture_photo(self, filepath):
         """Capture une photo et la sauvegarde au chemin indiqué."""
-        if self.backend == 'picamera':
-            self.camera.capture(filepath, format='jpeg')
-        elif self.backend == 'picamera2':
-            self.camera.capture_file(filepath)
-        elif self.backend == 'opencv':
-            ret, image = self.camera.read()
-            if not ret:
-                raise RuntimeError("Impossible de capturer une image")
-            cv2.imwrite(filepath, image)
-        else:
-            raise RuntimeError("Caméra Pi non initialisée")
+        raise RuntimeError("Caméra Pi non initialisée")
+
+    def _capture_photo_picamera(self, filepath):
+        self.camera.capture(filepath, format='jpeg')
+
+    def _capture_photo_picamera2(self, filepath):
+        self.camera.capture_file(filepath)
+
+    def _capture_photo_opencv(self, filepath):
+        ret, image = self.camera.read()
+        if not ret:
+            raise RuntimeError("Impossible de capturer une image")
+        cv2.imwrite(filepath, image)
 
     def stop(self):
-        self.is_running = False
+        # Réveille immédiatement les boucles : l'attente se limite à la frame en cours
+        self._stop_event.set()
+        self._frame_ready.set()
         if self.thread:
             self.thread.join(timeout=1.0)
+        if self.encoder_thread:
+            self.encoder_thread.join(timeout=1.0)
         try:
             if self.backend == 'picamera' and self.camera:
                 self.camera.close()
             elif self.backend == 'picamera2' and self.camera:
                 try:
-                    self.camera.stop()
+                    if self.encoder:
+                        self.camera.stop_recording()
+                    else:
+                        self.camera.stop()
                 except Exception:
                     pass
                 self.camera.close()
@@ -159,5 +509,8 @@ class PiCamera:
                 self.camera.release()
         finally:
             self.camera = None
+            self.encoder = None
+            self._unbind_backend()
+            self._clear_frames()
         logger.info("[PI CAMERA] Caméra arrêtée")
 
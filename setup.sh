@@ -197,7 +197,7 @@ install_dependencies() {
     python3 python3-venv python3-pip
     build-essential libcap2-bin libcap-dev
     xserver-xorg xinit x11-xserver-utils unclutter
-    libcamera-apps python3-opencv python3-picamera2
+    libcamera-apps python3-opencv python3-picamera2 libturbojpeg0
   )
   [[ -n "$CHROMIUM_PKG" ]] && pkgs+=("$CHROMIUM_PKG")
   step "Installation des dépendances"